@@ -1,12 +1,150 @@
-import json
+import atexit
+import mmap
 import os.path
-from configparser import ConfigParser, NoSectionError, NoOptionError
-from json import JSONDecodeError
-from typing import Callable, Optional
+import re
+import shutil
+import weakref
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from . import logger
 
-YES_NO_VALIDATOR = lambda _i: len(_i) == 1 and _i in 'YyNn'
+_YN_SET = frozenset({'Y', 'y', 'N', 'n'})
+YES_NO_VALIDATOR = _YN_SET.__contains__
+
+_MISSING = object()
+
+_orjson = _MISSING  # 初回のJSON読み込み時にorjsonをimportする（なければNone）
+# 19桁以上の整数。orjsonは64bitを超える整数をfloatにしてしまうので標準のjsonで読む
+_BIG_INT_RE = re.compile(r'(?<![\d.eE+-])-?\d{19,}(?![\d.eE])')
+
+_BOOL_MAP = {'true': True, 'false': False, 'yes': True, 'no': False, '1': True, '0': False}
+
+_DEFAULT_SECTION = 'DEFAULT'  # ConfigParserと同じく、全セクションに継承される値を置くセクション
+
+# 1行ずつ取り出す（改行をまたいでマッチさせると隣の行を値として取り込んでしまう）
+_LINE_RE = re.compile(rb'^([^\r\n]*)\r?$', re.M)
+# 以下は前後の空白を除いた1行に対して使う
+_SECTION_RE = re.compile(r'\[([^\]]+)\]$')
+_KV_RE = re.compile(r'(.*?)\s*[=:]\s*(.*)$')
+
+
+def _freeze(value):
+    """
+    JSONから得た値を読み取り専用にする（dict→MappingProxyType、list→tuple）
+    """
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _loads_json(text: str):
+    """
+    JSON文字列を読み込む。orjsonがあれば使い、結果が標準のjson.loadsと変わるもの
+    （64bitを超える整数、NaN・Infinity・1e400など）は標準のjsonで読む。
+    JSONモジュールは初回呼び出し時にimportする
+    """
+    global _orjson
+    if _orjson is _MISSING:
+        try:
+            import orjson as _orjson
+        except ImportError:
+            _orjson = None
+    if _orjson is not None and not _BIG_INT_RE.search(text):
+        try:
+            return _orjson.loads(text)
+        except _orjson.JSONDecodeError:
+            pass  # 標準のjsonなら読める値かもしれない。本当に不正ならそちらで例外になる
+    import json
+    return json.loads(text)
+
+
+def _dumps_json(value) -> str:
+    """
+    値をJSON文字列にする（デフォルト値の保存用）
+    """
+    import json
+    return json.dumps(value)
+
+
+def _parse_ini(buf, encoding: str = 'UTF-8') -> Dict[str, Dict[str, str]]:
+    """
+    INIのバイト列を {section: {key: value}} に変換する（読み込み専用の簡易パーサ）
+    ConfigParserと同様に'='と':'の両方を区切りとして扱い、キー名は小文字化する。
+    字下げされた行は直前の値の続き（複数行の値）として改行でつなぐ。
+    値は生の文字列のまま返し、ConfigParserのような'%'による補間は行わない。
+    解釈できない行は保存時に消えてしまうので、読み飛ばさずにValueErrorとする。
+    :param buf: bytes-like（mmapをそのまま渡せる）。ASCII互換のエンコーディングのみ対応。
+    """
+    data = {}  # type: Dict[str, Dict[str, str]]
+    options = None  # type: Optional[Dict[str, str]]
+    key = None  # 続きの行を受け付けるキー
+    blank = 0  # 値の途中にある空行の数
+    for lineno, m in enumerate(_LINE_RE.finditer(buf), 1):
+        line = m.group(1).decode(encoding)
+        stripped = line.strip()
+        if not stripped:
+            if key is not None:
+                blank += 1
+            continue
+        if stripped[0] in '#;':
+            continue
+        if key is not None and line[0].isspace():
+            options[key] += '\n' * (blank + 1) + stripped
+            blank = 0
+            continue
+        blank = 0
+
+        header = _SECTION_RE.match(stripped)
+        if header is not None:
+            options = data.setdefault(header.group(1), {})
+            key = None
+            continue
+        kv = _KV_RE.match(stripped)
+        if options is None or kv is None or not kv.group(1):
+            raise ValueError('line {}: cannot parse {!r}'.format(lineno, line))
+        key = kv.group(1).lower()
+        options[key] = kv.group(2)
+    return data
+
+
+def _round_trip(value: str) -> str:
+    """
+    値を_serialize()と同じ形式で書き出し、_parse_ini()で読み直した結果を返す
+    """
+    text = '[s]\nk = {}\n'.format(value.replace('\n', '\n\t'))
+    return _parse_ini(text.encode('UTF-8'))['s'].get('k', '')
+
+
+def _parse_bool(value: str) -> bool:
+    """
+    _BOOL_MAPに従って真偽値に変換する。該当しなければValueError
+    """
+    try:
+        return _BOOL_MAP[value.lower()]
+    except KeyError:
+        raise ValueError(value) from None
+
+
+# 終了時にflush()するインスタンス。弱参照なので使い終わったインスタンスは解放される
+_instances = weakref.WeakSet()  # type: weakref.WeakSet
+
+
+@atexit.register
+def _flush_all():
+    for conf in list(_instances):
+        conf.flush()
+
+
+_TYPE_PARSERS = {
+    str: str,
+    int: lambda v: int(v, 10),
+    float: float,
+    bool: _parse_bool,
+    'json': lambda v: _freeze(_loads_json(v)),
+}  # type: Dict[Any, Callable[[str], Any]]
 
 
 class Configure:
@@ -14,14 +152,36 @@ class Configure:
     config.ini周りの記録設定を司る
     """
 
-    def __init__(self, configure_path, encoding='UTF-8'):
+    def __init__(self, configure_path, encoding='UTF-8', autoflush: bool = False):
         """
         :param configure_path: config.iniへのパス
+        :param autoflush: Trueならwrite()のたびに保存する。Falseならflush()かclose()、終了時にまとめて保存する。
         """
-        self._config = ConfigParser()
+        self._data = {}  # type: Dict[str, Dict[str, str]]
         self.configure_path = configure_path
+        self._stat = None  # type: Optional[Tuple[float, int]]
+        # (section, 小文字化したkey) → {型: 変換済みの値}
+        self._cache = {}  # type: Dict[Tuple[str, str], Dict[Any, Any]]
+        # 保存前のwrite()。ファイルを読み直すたびに上書きで適用し直す
+        self._pending = {}  # type: Dict[Tuple[str, str], str]
+        self._dirty = False
+        self._autoflush = autoflush
         self.logger = logger.get_logger('utils.configure')
         self._reload(encoding, force_quit=False)
+        _instances.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        未保存の変更を保存し、終了時のflush対象から外す
+        """
+        self.flush()
+        _instances.discard(self)
 
     @staticmethod
     def _prompt(prompt: str, validator: Callable[[str], bool] = lambda _i: True, default=None) -> str:
@@ -41,12 +201,25 @@ class Configure:
             elif validator(_input):
                 return _input
 
+    def _serialize(self) -> str:
+        """
+        設定値をINI形式の文字列にする（キーはセクションごとにソート）
+        """
+        parts = []
+        append = parts.append
+        for section, options in self._data.items():
+            append('[{}]\n'.format(section))
+            for k, v in sorted(options.items()):
+                append('{} = {}\n'.format(k, str(v).replace('\n', '\n\t')))
+            append('\n')
+        return ''.join(parts)
+
     def export(self, configure_path, force=False) -> bool:
         if os.path.exists(configure_path) and not force:
-            self.logger.error('{} is already exist.')
+            self.logger.error('%s is already exist.', configure_path)
         else:
-            with open(configure_path, 'w') as configfile:
-                self._config.write(configfile)
+            with open(configure_path, 'w', buffering=-1) as configfile:
+                configfile.write(self._serialize())
                 self.logger.debug('Save successful!')
                 return True
         return False
@@ -57,163 +230,256 @@ class Configure:
         :param encoding: config file's encoding.
         :param force_quit:
         """
-        if os.path.exists(self.configure_path):
-            self._config.read(self.configure_path, encoding)
-        else:
+        try:
+            st = os.stat(self.configure_path)
+        except FileNotFoundError:
             if force_quit:
-                self.logger.error('{} is not exist. Plz make it first.'.format(self.configure_path))
+                self.logger.error('%s is not exist. Plz make it first.', self.configure_path)
                 exit(1)
             else:
                 _i = Configure._prompt('{} is not exist. Create it? [Y/n]'.format(self.configure_path),
                                        YES_NO_VALIDATOR, 'y')
                 if _i in 'Yy':
                     self.export(self.configure_path)
+            return
+        self._load(st, encoding)
+
+    def _load(self, st: os.stat_result, encoding: str = 'UTF-8'):
+        """
+        ファイルが変わっていれば読み直し、保存前のwrite()を上から適用する
+        :param st: configure_pathのstat
+        """
+        stat = (st.st_mtime, st.st_size)
+        if stat == self._stat:  # 変更がなければ読み直さない
+            return
+        if st.st_size == 0:  # 空ファイルはmmapできない
+            data = {}
+        else:
+            with open(self.configure_path, 'rb') as configfile, \
+                    mmap.mmap(configfile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                data = _parse_ini(mm, encoding)
+        for (section, key), value in self._pending.items():
+            data.setdefault(section, {})[key] = value
+        self._data = data
+        self._stat = stat
+        self._cache.clear()
+
+    def refresh(self, encoding: str = 'UTF-8'):
+        """
+        変更の有無にかかわらず設定ファイルを読み直す
+        未保存の変更は先に保存される
+        """
+        self.flush()
+        self._stat = None
+        self._reload(encoding)
 
     def _save(self):
         """
         Sort all keys then save config.
+        保存直前にファイルを読み直すので、他から追加された値は消さない
         """
-        for section in self._config.sections():
-            for (k, v) in sorted(self._config.items(section), key=lambda x: x[0]):
-                self._config.remove_option(section, k)
-                self._config.set(section, k, v)
+        try:
+            st = os.stat(self.configure_path)
+        except FileNotFoundError:
+            pass
+        else:
+            self._stat = None  # 同じmtime・サイズのまま書き換えられていても読み直す
+            self._load(st)
+        path = os.path.realpath(self.configure_path)  # シンボリックリンクならリンク先を書き換える
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'w', buffering=-1) as configfile:
+                configfile.write(self._serialize())
+            try:
+                shutil.copymode(path, tmp_path)  # 0600などのパーミッションを引き継ぐ
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        st = os.stat(self.configure_path)
+        self._stat = (st.st_mtime, st.st_size)
+        self._pending.clear()
+        self._dirty = False
 
-        with open(self.configure_path, 'w') as configfile:
-            self._config.write(configfile)
+    def flush(self):
+        """
+        未保存の変更があれば保存する
+        """
+        if self._dirty:
+            self._save()
 
-    def _read_conf(self, section: str, key: str, default_val: str = None, required: bool = True) -> Optional[str]:
+    def _store(self, section: str, key: str, kind, value):
         """
-        設定値の読み込み
+        型変換済みの設定値をキャッシュに保存
+        """
+        self._cache.setdefault((section, key.lower()), {})[kind] = value
+
+    def _read_conf(self, section: str, key: str, default_val: str = None,
+                   required: bool = True) -> Tuple[Optional[str], bool]:
+        """
+        設定値の読み込み（_reload()は呼び出し側で行う）
         :param str section: Section name. NOT EMPTY!
         :param str key: Key name. NOT EMPTY!
         :param default_val: 値が指定されていない時に使われる値。default=Noneはrequired=Falseでのみ容認。
         :param required: bool Trueなら、値が不正な時スクリプトが止まる。
-        :return: Optional[str] 取得できればその値。できなければNone。
+        :return: (値, 設定ファイルに存在したか)。値は取得できなければデフォルト値かNone。
         """
-        self._reload()
-        if not section or not key:
-            self.logger.error('Plz specify section/key name!')
-            return None
-
         try:
-            return self._config.get(section, key)
-        except NoSectionError:
-            self.logger.error('no section named {}.'.format(section))
-        except NoOptionError:
-            self.logger.error('no value for {}.{}'.format(section, key))
+            options = self._data[section]
+        except KeyError:
+            self.logger.error('no section named %s.', section)
+        else:
+            value = options.get(key.lower(), self._data.get(_DEFAULT_SECTION, {}).get(key.lower()))
+            if value is not None:
+                return value, True
+            self.logger.error('no value for %s.%s', section, key)
 
         if required and default_val is None:
             self.logger.error('this field cannot to be set None')
         else:
-            self.logger.info('use default value: {}.'.format(default_val))
-            return default_val
-        return None
+            self.logger.info('use default value: %s.', default_val)
+            return default_val, False
+        return None, False
 
-    def read(self, section: str, key: str, default_val: str = None, required: bool = True) -> Optional[str]:
+    def _read_typed(self, section: str, key: str, kind, default_val=None, required: bool = True,
+                    persist_default: bool = False) -> Any:
+        """
+        型変換付きの設定値の読み込み（_reload()は呼び出し側で行う）
+        :param kind: _TYPE_PARSERSのキー（str/int/float/bool/'json'）
+        :param persist_default: Trueなら、設定ファイルにない時に使ったデフォルト値を保存する
+        """
+        try:
+            parser = _TYPE_PARSERS[kind]
+        except KeyError:
+            raise ValueError('unsupported type: {!r}'.format(kind)) from None
+        if not section or not key:  # キャッシュのキーを作る前に確認する
+            self.logger.error('Plz specify section/key name!')
+            return None
+        cached = self._cache.get((section, key.lower()), {}).get(kind, _MISSING)
+        if cached is not _MISSING:
+            return cached
+        value, present = self._read_conf(section, key, default_val, required)
+        if value is None:
+            return None
+        if not present and kind == 'json':  # JSONのデフォルト値は文字列を経由せずそのまま使う
+            if persist_default:
+                self.write(section, key, _dumps_json(default_val))
+            return _freeze(default_val)
+        if not present:
+            value = str(value)  # デフォルト値も設定値と同じく文字列から変換する
+        try:
+            parsed = parser(value)
+        except ValueError:  # JSONDecodeErrorもValueErrorのサブクラス
+            self.logger.warning('value type for %s.%s is not "%s" (value = %s).',
+                                section, key, getattr(kind, '__name__', kind), value)
+            if type(default_val) is not kind:
+                return None
+            parsed = default_val
+        else:
+            if present:
+                self._store(section, key, kind, parsed)
+        if persist_default and not present:  # デフォルト値が保存されてないなら保存してしまう
+            self.write(section, key, str(parsed))
+        return parsed
+
+    def read(self, section: str, key: str, default_val: str = None, required: bool = True,
+             persist_default: bool = False) -> Optional[str]:
         """
         設定値の読み込み
         param → read help(_read_conf).
+        :param persist_default: Trueなら、設定ファイルにない時に使ったデフォルト値を保存する
         """
-        value = self._read_conf(section, key, default_val, required)
-        try:
-            self._config.get(section, key)
-        except (NoSectionError, NoOptionError):
-            if value is not None:  # デフォルト値が保存されてないなら保存してしまう
-                self.write(section, key, value)
-        return value
+        self._reload()
+        return self._read_typed(section, key, str, default_val, required, persist_default)
 
-    def read_bool(self, section: str, key: str, default_val: bool = None, required: bool = True) -> Optional[bool]:
+    def read_bool(self, section: str, key: str, default_val: bool = None, required: bool = True,
+                  persist_default: bool = False) -> Optional[bool]:
         """
         bool型設定値の読み込み
         param → read help(_read_conf).
+        :param persist_default: Trueなら、設定ファイルにない時に使ったデフォルト値を保存する
         """
-        value = self._read_conf(section, key, str(default_val), required)
-        value_b = None
-        if type(value) is not str:
-            self.logger.warning('value type for {}.{} is not "bool" (value = {}).'.format(section, key, value))
-            if type(default_val) is bool:
-                value_b = default_val
-        else:
-            _v = value.upper()
-            if _v in ['TRUE', 'FALSE']:
-                value_b = _v == 'TRUE'
-            else:
-                self.logger.warning('value type for {}.{} is not "bool" (value = {}).'.format(section, key, value))
-                if type(default_val) is bool:
-                    value_b = default_val
-        try:
-            self._config.get(section, key)
-        except (NoSectionError, NoOptionError):
-            if value_b is not None:  # デフォルト値が保存されてないなら保存してしまう
-                self.write(section, key, str(value_b))
-        return value_b
+        self._reload()
+        return self._read_typed(section, key, bool, default_val, required, persist_default)
 
-    def read_float(self, section: str, key: str, default_val: float = None, required: bool = True) -> Optional[float]:
+    def read_float(self, section: str, key: str, default_val: float = None, required: bool = True,
+                   persist_default: bool = False) -> Optional[float]:
         """
         浮動小数点型設定値の読み込み
         param → read help(read_conf).
+        :param persist_default: Trueなら、設定ファイルにない時に使ったデフォルト値を保存する
         """
-        value = self._read_conf(section, key, str(default_val), required)
-        value_f = None
-        try:
-            value_f = float(value)
-        except ValueError:
-            self.logger.warning('value type for {}.{} is not "float" (value = {}).'.format(section, key, value))
-            if type(default_val) is float:
-                value_f = default_val
-        try:
-            self._config.get(section, key)
-        except (NoSectionError, NoOptionError):
-            if value_f is not None:  # デフォルト値が保存されてないなら保存してしまう
-                self.write(section, key, str(value_f))
-        return value_f
+        self._reload()
+        return self._read_typed(section, key, float, default_val, required, persist_default)
 
-    def read_int(self, section: str, key: str, default_val: int = None, required: bool = True) -> Optional[int]:
+    def read_int(self, section: str, key: str, default_val: int = None, required: bool = True,
+                 persist_default: bool = False) -> Optional[int]:
         """
         整数型設定値の読み込み
         param → read help(_read_conf).
+        :param persist_default: Trueなら、設定ファイルにない時に使ったデフォルト値を保存する
         """
-        value = self._read_conf(section, key, str(default_val), required)
-        value_i = None
-        try:
-            value_i = int(value, 10)
-        except ValueError:
-            self.logger.warning('value type for {}.{} is not "int" (value = {}).'.format(section, key, value))
-            if type(default_val) is int:
-                value_i = default_val
-        try:
-            self._config.get(section, key)
-        except (NoSectionError, NoOptionError):
-            if value_i is not None:  # デフォルト値が保存されてないなら保存してしまう
-                self.write(section, key, str(value_i))
-        return value_i
+        self._reload()
+        return self._read_typed(section, key, int, default_val, required, persist_default)
 
     def read_json(self, section: str, key: str):
         """
         JSON型設定値の読み込み
+        結果はキャッシュされるため、dictはMappingProxyType、listはtupleとして読み取り専用で返す
         param → read help(_read_conf).
         """
-        ret = self._read_conf(section, key)
+        self._reload()
+        return self._read_typed(section, key, 'json')
+
+    def read_many(self, spec: List[Tuple[str, str, Any, Any]],
+                  persist_default: bool = False) -> Dict[Tuple[str, str], Any]:
+        """
+        複数の設定値をまとめて読み込む。設定ファイルの確認は1回だけ行う。
+        :param spec: (section, key, 型, デフォルト値) のリスト。型はstr/int/float/bool/'json'
+        :param persist_default: Trueなら、使ったデフォルト値を最後に1回でまとめて保存する
+        :return: {(section, key): 値}
+        """
+        self._reload()
+        autoflush, self._autoflush = self._autoflush, False
         try:
-            return json.loads(ret)
-        except JSONDecodeError:
-            self.logger.warning("Value type for {}.{} is not \"json\" (value = {}).".format(section, key, ret))
-        return None
+            values = {(section, key): self._read_typed(section, key, kind, default_val,
+                                                       persist_default=persist_default)
+                      for section, key, kind, default_val in spec}
+        finally:
+            self._autoflush = autoflush
+        if autoflush:
+            self.flush()
+        return values
 
     def write(self, section: str, key: str, value: str, store: bool = True):
         """
         設定値の書き込み
+        :param store: Trueなら保存対象にする（autoflush=Falseの場合、実際の保存はflush()時）
         """
         self._reload()
         if not section or not key:
             self.logger.error('Plz specify section/key name!')
             exit(1)
-        try:
-            self._config.set(section, key, value)
-        except NoSectionError:
-            self.logger.warning('No section named {}. Create new one.'.format(section))
-            self._config.add_section(section)
-            self._config.set(section, key, value)
-        self.logger.info('Set value: {}.{} = {}.'.format(section, key, value))
+        if not isinstance(value, str):  # ConfigParser.set()と同じく文字列以外は受け付けない
+            raise TypeError('option values must be strings')
+        if ('\n' in value or '\r' in value) and _round_trip(value) != value:
+            # 行頭・行末の空白、'#'/';'で始まる行、末尾の空行などは続きの行として保存すると失われる
+            raise ValueError('multi-line value cannot be saved as is: {!r}'.format(value))
+        if section not in self._data:
+            self.logger.warning('No section named %s. Create new one.', section)
+            self._data[section] = {}
+        self._data[section][key.lower()] = value
+        self._pending[(section, key.lower())] = value
+        if section == _DEFAULT_SECTION:  # 他のセクションに継承されている値も変わる
+            self._cache.clear()
+        self._cache[(section, key.lower())] = {str: value}
+        self.logger.info('Set value: %s.%s = %s.', section, key, value)
         if store:
-            self._save()
+            self._dirty = True
+            if self._autoflush:
+                self._save()
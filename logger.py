@@ -1,20 +1,24 @@
 import logging
 
+_FORMATTER = logging.Formatter('%(created).3f [%(name)s] <%(levelname)s> %(message)s')
+
 
 def get_logger(logger_name: str, log_level: int = logging.DEBUG) -> logging.Logger:
     """
     ロガーを生成
+    同じ名前で何度呼んでもハンドラは1つだけ付ける
     :param logger_name:
     :param log_level:
     :return:
     """
     logger = logging.getLogger(logger_name)
     logger.setLevel(log_level)
+    if logger.handlers:
+        return logger
 
-    stream_handler = logging.StreamHandler()
-    stream_handler.setLevel(log_level)
-    handler_format = logging.Formatter('%(asctime)s [%(name)s] <%(levelname)s> %(message)s')
-    stream_handler.setFormatter(handler_format)
+    stream_handler = logging.StreamHandler()  # レベルはロガー側だけで判定する（ハンドラはNOTSETのまま）
+    stream_handler.setFormatter(_FORMATTER)
 
     logger.addHandler(stream_handler)
+    logger.propagate = False
     return logger
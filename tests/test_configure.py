@@ -0,0 +1,262 @@
+import gc
+import math
+import os
+import stat
+import tempfile
+import unittest
+import weakref
+from unittest import mock
+
+from .. import configure
+from ..configure import Configure, _instances, _loads_json, _parse_ini
+
+
+class ParseIniTest(unittest.TestCase):
+
+    def test_empty_value_does_not_take_next_line(self):
+        self.assertEqual(_parse_ini(b'[s]\na =\nb = 1\n'), {'s': {'a': '', 'b': '1'}})
+
+    def test_crlf(self):
+        self.assertEqual(_parse_ini(b'[s]\r\nA = 1\r\nb =\r\n\r\n[t]\r\nc = x = y\r\n'),
+                         {'s': {'a': '1', 'b': ''}, 't': {'c': 'x = y'}})
+
+    def test_comments(self):
+        self.assertEqual(_parse_ini(b'[s]\n; a = 1\n# b = 2\nc = 3\n'), {'s': {'c': '3'}})
+
+    def test_colon_delimiter(self):
+        self.assertEqual(_parse_ini(b'[s]\na: 1\nb = x:y\n'), {'s': {'a': '1', 'b': 'x:y'}})
+
+    def test_continuation_lines(self):
+        self.assertEqual(_parse_ini(b'[s]\nb = line1\n  line2\n\n\tline3\nc = 1\n'),
+                         {'s': {'b': 'line1\nline2\n\nline3', 'c': '1'}})
+
+    def test_unparseable_line_raises(self):
+        with self.assertRaises(ValueError):
+            _parse_ini(b'[s]\nfoo\nb = 1\n')
+        with self.assertRaises(ValueError):
+            _parse_ini(b'a = 1\n[s]\n')
+
+
+class LoadsJsonTest(unittest.TestCase):
+
+    def test_matches_stdlib_json(self):
+        self.assertEqual(_loads_json('123456789012345678901234567890'), 123456789012345678901234567890)
+        self.assertEqual(_loads_json('[-99999999999999999999, 1.5]'), [-99999999999999999999, 1.5])
+        self.assertEqual(_loads_json('{"id": "12345678901234567890"}'), {'id': '12345678901234567890'})
+        self.assertTrue(math.isnan(_loads_json('NaN')))
+        self.assertEqual(_loads_json('1e400'), float('inf'))
+
+    def test_invalid_json_raises(self):
+        with self.assertRaises(ValueError):
+            _loads_json('{')
+
+
+class ConfigureTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.ini')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_empty_value_round_trip(self):
+        c = Configure(self.path)
+        c.write('s', 'a', '')
+        c.write('s', 'b', '2')
+        c.flush()
+        c2 = Configure(self.path)
+        self.assertEqual(c2.read('s', 'a'), '')
+        self.assertEqual(c2.read('s', 'b'), '2')
+
+    def test_read_many_json_defaults(self):
+        c = Configure(self.path)
+        values = c.read_many([('s', 'd', 'json', {'a': 1}), ('s', 't', 'json', True),
+                              ('s', 'l', 'json', [1, 2])], persist_default=True)
+        self.assertEqual(dict(values[('s', 'd')]), {'a': 1})
+        self.assertIs(values[('s', 't')], True)
+        self.assertEqual(values[('s', 'l')], (1, 2))
+        c.flush()
+        c2 = Configure(self.path)
+        self.assertEqual(dict(c2.read_json('s', 'd')), {'a': 1})
+        self.assertIs(c2.read_json('s', 't'), True)
+        self.assertEqual(c2.read_json('s', 'l'), (1, 2))
+
+    def test_read_many_unsupported_type(self):
+        c = Configure(self.path)
+        with self.assertRaises(ValueError):
+            c.read_many([('s', 'foo', list, None)])
+
+    def test_read_bool_invalid_value_uses_default(self):
+        c = Configure(self.path)
+        c.write('s', 'b', 'maybe')
+        self.assertIs(c.read_bool('s', 'b', True), True)
+
+    def test_cache_key_is_case_insensitive(self):
+        c = Configure(self.path)
+        c.write('s', 'FOO', '1')
+        self.assertEqual(c.read_int('s', 'FOO'), 1)
+        c.write('s', 'foo', '5')
+        self.assertEqual(c.read_int('s', 'FOO'), 5)
+        self.assertEqual(c.read_int('s', 'foo'), 5)
+
+    def test_write_rejects_non_str(self):
+        c = Configure(self.path)
+        with self.assertRaises(TypeError):
+            c.write('s', 'n', 5)
+        self.assertIsNone(c.read('s', 'n', required=False))
+
+    def test_released_instance_is_not_kept(self):
+        c = Configure(self.path)
+        self.assertIn(c, _instances)
+        ref = weakref.ref(c)
+        del c
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def test_close_flushes(self):
+        with Configure(self.path) as c:
+            c.write('s', 'a', '1')
+        self.assertNotIn(c, _instances)
+        self.assertEqual(Configure(self.path).read('s', 'a'), '1')
+
+    def test_flush_keeps_external_changes(self):
+        c = Configure(self.path)
+        c.write('s', 'a', '1')
+        with open(self.path, 'a') as f:
+            f.write('[s]\next = 9\n')
+        self.assertEqual(c.read('s', 'ext'), '9')  # 保存前でもファイルの変更は見える
+        self.assertEqual(c.read('s', 'a'), '1')
+        c.flush()
+        c2 = Configure(self.path)
+        self.assertEqual(c2.read('s', 'ext'), '9')
+        self.assertEqual(c2.read('s', 'a'), '1')
+
+    def test_default_section_and_lossless_save(self):
+        with open(self.path, 'w') as f:
+            f.write('[DEFAULT]\nbase = 1\n[s]\na: 1\nb = line1\n  line2\n')
+        c = Configure(self.path)
+        self.assertEqual(c.read('s', 'base'), '1')
+        c.write('s', 'c', '3')
+        c.flush()
+        c2 = Configure(self.path)
+        self.assertEqual(c2.read('s', 'base'), '1')
+        self.assertEqual(c2.read('s', 'a'), '1')
+        self.assertEqual(c2.read('s', 'b'), 'line1\nline2')
+        self.assertEqual(c2.read('s', 'c'), '3')
+
+    def test_default_section_write_updates_inherited_value(self):
+        c = Configure(self.path)
+        c.write('DEFAULT', 'base', '1')
+        c.write('s', 'own', 'x')
+        self.assertEqual(c.read_int('s', 'base'), 1)
+        c.write('DEFAULT', 'base', '2')
+        self.assertEqual(c.read_int('s', 'base'), 2)
+
+    def test_multi_line_value_round_trip(self):
+        c = Configure(self.path)
+        c.write('s', 'm', 'l1\nl2\n\nl3')
+        c.flush()
+        self.assertEqual(Configure(self.path).read('s', 'm'), 'l1\nl2\n\nl3')
+
+    def test_write_rejects_multi_line_value_that_would_change(self):
+        c = Configure(self.path)
+        for value in ('l1\n  l2', 'l1\n# l2', 'l1\n', 'l1\r\nl2'):
+            with self.assertRaises(ValueError):
+                c.write('s', 'm', value)
+
+    def test_save_keeps_mode_and_symlink(self):
+        os.chmod(self.path, 0o600)
+        link = self.path + '.link'
+        os.symlink(self.path, link)
+        try:
+            c = Configure(link)
+            c.write('s', 'a', '1')
+            c.flush()
+            self.assertTrue(os.path.islink(link))
+            self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+            self.assertEqual(Configure(self.path).read('s', 'a'), '1')
+        finally:
+            os.remove(link)
+
+    def test_failed_save_removes_tmp_file(self):
+        c = Configure(self.path)
+        c.write('s', 'a', '1')
+        c._serialize = lambda: 1 / 0
+        with self.assertRaises(ZeroDivisionError):
+            c.flush()
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+        del c._serialize
+        c.close()
+
+    def test_empty_section_or_key_returns_none(self):
+        c = Configure(self.path)
+        self.assertIsNone(c.read('s', None))
+        self.assertIsNone(c.read_int('', 'a', 1))
+
+    def test_refresh_rereads_external_edit(self):
+        with open(self.path, 'w') as f:
+            f.write('[s]\na = 1\n')
+        st = os.stat(self.path)
+        c = Configure(self.path)
+        self.assertEqual(c.read('s', 'a'), '1')
+        with open(self.path, 'w') as f:  # mtimeもサイズも同じなので通常の読み込みでは気付けない
+            f.write('[s]\na = 2\n')
+        os.utime(self.path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(c.read('s', 'a'), '1')
+        c.refresh()
+        self.assertEqual(c.read('s', 'a'), '2')
+
+    def test_refresh_flushes_pending_writes_first(self):
+        c = Configure(self.path)
+        c.write('s', 'a', '1')
+        c.refresh()
+        self.assertEqual(c.read('s', 'a'), '1')
+        self.assertEqual(Configure(self.path).read('s', 'a'), '1')
+
+    def test_default_is_not_persisted_by_default(self):
+        with open(self.path, 'w') as f:
+            f.write('[s]\na = 1\n')
+        c = Configure(self.path)
+        self.assertEqual(c.read_int('s', 'b', 5), 5)
+        self.assertEqual(c.read('t', 'c', 'x'), 'x')
+        c.flush()
+        with open(self.path) as f:
+            self.assertEqual(f.read(), '[s]\na = 1\n')
+
+    def test_persist_default_writes_value(self):
+        with open(self.path, 'w') as f:
+            f.write('[s]\na = 1\n')
+        c = Configure(self.path)
+        self.assertEqual(c.read_int('s', 'b', 5, persist_default=True), 5)
+        self.assertIs(c.read_bool('t', 'c', True, persist_default=True), True)
+        c.flush()
+        c2 = Configure(self.path)
+        self.assertEqual(c2.read('s', 'b'), '5')
+        self.assertEqual(c2.read('t', 'c'), 'True')
+
+    def test_unchanged_file_is_not_reparsed(self):
+        with open(self.path, 'w') as f:
+            f.write('[s]\na = 1\n')
+        c = Configure(self.path)
+        with mock.patch.object(configure, '_parse_ini', wraps=configure._parse_ini) as parse:
+            c.read('s', 'a')
+            c.read_int('s', 'a')
+            self.assertEqual(parse.call_count, 0)
+            with open(self.path, 'a') as f:
+                f.write('b = 2\n')
+            self.assertEqual(c.read('s', 'b'), '2')
+            self.assertEqual(parse.call_count, 1)
+
+    def test_empty_file(self):
+        c = Configure(self.path)  # mkstempで作った0バイトのファイル
+        self.assertEqual(c.read('s', 'a', 'x'), 'x')
+        with open(self.path, 'w') as f:
+            f.write('[s]\na = 1\n')
+        self.assertEqual(c.read('s', 'a'), '1')
+        open(self.path, 'w').close()
+        self.assertEqual(c.read('s', 'a', 'x'), 'x')
+
+
+if __name__ == '__main__':
+    unittest.main()
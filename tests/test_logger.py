@@ -0,0 +1,18 @@
+import logging
+import unittest
+
+from ..logger import get_logger
+
+
+class GetLoggerTest(unittest.TestCase):
+
+    def test_single_handler_follows_logger_level(self):
+        get_logger('utils.test_logger', logging.INFO)
+        logger = get_logger('utils.test_logger', logging.DEBUG)
+        self.assertEqual(len(logger.handlers), 1)
+        self.assertEqual(logger.level, logging.DEBUG)
+        self.assertEqual(logger.handlers[0].level, logging.NOTSET)
+
+
+if __name__ == '__main__':
+    unittest.main()